@@ -1,34 +1,138 @@
-from flask import Flask, render_template, request
+from quart import Quart, render_template, request
 import pandas as pd
+import asyncio
 import os
+import re
 from agents.main import clean_provider   # Gemini agent
+from tools import preclean_dataframe, score_record
 
-app = Flask(__name__)
+app = Quart(__name__)
 
 UPLOAD_FOLDER = "uploads"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
+# Keep Flask's limits: Quart defaults to a 16 MiB body cap and a 60s
+# response timeout, which large uploads and long agent runs both hit
+app.config["MAX_CONTENT_LENGTH"] = None
+app.config["RESPONSE_TIMEOUT"] = None
+
+# Max Gemini requests in flight per upload
+LLM_CONCURRENCY = 5
+
+# Fields the cleaning pipeline understands
+PROVIDER_COLUMNS = ["name", "phone", "email", "address", "specialty", "city", "license"]
+
+# Common header spellings (normalized) -> canonical PROVIDER_COLUMNS name
+COLUMN_ALIASES = {
+    "doctor": "name", "doctor name": "name", "provider name": "name", "full name": "name",
+    "phone number": "phone", "phone no": "phone", "mobile": "phone", "mobile number": "phone",
+    "contact": "phone", "contact number": "phone", "telephone": "phone",
+    "e mail": "email", "email address": "email", "mail": "email",
+    "clinic address": "address", "full address": "address", "location": "address",
+    "speciality": "specialty", "specialization": "specialty", "specialisation": "specialty",
+    "department": "specialty",
+    "town": "city",
+    "licence": "license", "license number": "license", "licence number": "license",
+    "license no": "license", "registration number": "license",
+}
+
+
+def _canonical_columns(header):
+    """
+    Rename map from CSV header names to PROVIDER_COLUMNS, ignoring case,
+    spacing and common synonyms. Unrecognised columns are left as they
+    are so the agent still sees them.
+    """
+    renames = {}
+    # Exact canonical names keep priority over aliases
+    taken = {column for column in header if column in PROVIDER_COLUMNS}
+    for column in header:
+        if column in taken:
+            continue
+        key = re.sub(r"[\s_\-]+", " ", str(column)).strip().lower()
+        canonical = key if key in PROVIDER_COLUMNS else COLUMN_ALIASES.get(key)
+        # First column claiming a canonical name wins; others keep theirs
+        if canonical and canonical not in taken:
+            taken.add(canonical)
+            renames[column] = canonical
+    return renames
+
+
+def _load_records(path):
+    """
+    Parse and pre-clean the upload. Returns (records, needs_llm), where
+    needs_llm is a list of flags for the rows the LLM still has to fix
+    """
+    # Read as text so phone numbers aren't turned into floats. All
+    # columns are kept, unrecognised ones still go to the agent.
+    options = {"dtype": "string[pyarrow]", "keep_default_na": False}
+    try:
+        df = pd.read_csv(path, engine="pyarrow", **options)
+    except pd.errors.ParserError:
+        # pyarrow rejects rows with missing trailing fields; the C
+        # parser pads them with empty strings instead
+        df = pd.read_csv(path, **options)
+    df = df.rename(columns=_canonical_columns(df.columns))
+
+    # Rule-based cleaning for every row; only rows that still
+    # have issues go to the LLM
+    df, needs_llm = preclean_dataframe(df)
+    return df.to_dict(orient="records"), needs_llm.tolist()
+
+
+async def _process(records):
+    """
+    Clean all records concurrently, keeping at most LLM_CONCURRENCY
+    Gemini calls in flight. Results come back in input order.
+    """
+    semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+
+    async def bounded(provider):
+        async with semaphore:
+            # clean_provider is blocking I/O, run it off the event loop
+            return await asyncio.to_thread(clean_provider, provider)
+
+    return await asyncio.gather(*[bounded(r) for r in records])
 
 
 @app.route("/", methods=["GET", "POST"])
-def index():
+async def index():
     if request.method == "POST":
-        file = request.files.get("file")
+        files = await request.files
+        file = files.get("file")
 
         if not file:
             return "No file uploaded", 400
 
         path = os.path.join(app.config["UPLOAD_FOLDER"], file.filename)
-        file.save(path)
+        await file.save(path)
 
-        df = pd.read_csv(path)
-        results = []
+        # CSV parsing is CPU-bound, keep it off the event loop
+        try:
+            records, needs_llm = await asyncio.to_thread(_load_records, path)
+        except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+            return f"Could not read CSV: {e}", 400
+        llm_rows = [i for i, needed in enumerate(needs_llm) if needed]
+
+        # Identical rows share one agent call; results are broadcast back
+        row_keys = {i: tuple(records[i].items()) for i in llm_rows}
+        unique_keys = list(dict.fromkeys(row_keys.values()))
 
-        for _, row in df.iterrows():
-            provider = row.to_dict()
+        # Call Gemini-powered agent
+        cleaned = await _process([dict(key) for key in unique_keys])
+        by_key = dict(zip(unique_keys, cleaned))
+        llm_results = {i: by_key[key] for i, key in row_keys.items()}
 
-            # Call Gemini-powered agent
-            result = clean_provider(provider)
+        results = []
+        for i, record in enumerate(records):
+            result = llm_results.get(i)
+            if result is None:
+                results.append({
+                    **record,
+                    "accuracy_score": score_record(record),
+                    "issues": ""
+                })
+                continue
 
             results.append({
                 **result.cleaned_data,
@@ -36,10 +140,12 @@ def index():
                 "issues": ", ".join(result.issues)
             })
 
-        return render_template("results.html", results=results)
+        return await render_template("results.html", results=results)
 
-    return render_template("index.html")
+    return await render_template("index.html")
 
 
+# Development server only. In production run it under an ASGI server, e.g.
+#   gunicorn -k uvicorn.workers.UvicornWorker app:app -w 4 --timeout 300
 if __name__ == "__main__":
     app.run(debug=True)
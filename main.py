@@ -1,12 +1,26 @@
 import os
 import json
-import re
+import hashlib
+import random
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
+import httpx
 from dotenv import load_dotenv
 from pydantic import BaseModel, ValidationError
-from openai import OpenAI
+from openai import OpenAI, APIError, APIStatusError, APIConnectionError, RateLimitError
 from httpx import HTTPError
+from tools import (DIGITS_RE, EMAIL_RE, format_indian_phone, standardize_specialty,
+                   invalid_fields, score_record)
+import diskcache
+
+try:
+    import faiss
+    from sentence_transformers import SentenceTransformer
+except ImportError:  # semantic cache is disabled without these
+    faiss = None
+    SentenceTransformer = None
 
 # --------------------------------------------------
 # ENV SETUP
@@ -17,9 +31,22 @@ API_KEY = os.getenv("PERPLEXITY_API_KEY")
 if not API_KEY:
     raise ValueError("PERPLEXITY_API_KEY not found in .env file")
 
+# One pooled keep-alive client so TCP/TLS handshakes are paid once,
+# not on every search / cleaning request
+http_client = httpx.Client(
+    limits=httpx.Limits(
+        max_keepalive_connections=20,
+        max_connections=20,
+        keepalive_expiry=60.0,
+    ),
+    timeout=30.0,
+)
+
 client = OpenAI(
     api_key=API_KEY,
-    base_url="https://api.perplexity.ai"
+    base_url="https://api.perplexity.ai",
+    http_client=http_client,
+    max_retries=0,  # retries are handled by call_perplexity_with_retry
 )
 
 # --------------------------------------------------
@@ -31,50 +58,276 @@ class ProviderResponse(BaseModel):
     accuracy_score: int
     enriched_fields: List[str] = []
 
+class SearchResult(BaseModel):
+    found_info: Dict[str, str]
+    confidence: str
+    search_summary: str
+
+def json_schema_format(model: type[BaseModel]) -> dict:
+    """
+    Structured-output response_format so the API returns valid JSON
+    """
+    return {"type": "json_schema", "json_schema": {"schema": model.model_json_schema()}}
+
+SEARCH_RESPONSE_FORMAT = json_schema_format(SearchResult)
+CLEANING_RESPONSE_FORMAT = json_schema_format(ProviderResponse)
+# Batch items echo the input record's id so results can't be misassigned
+_BATCH_ITEM_SCHEMA = ProviderResponse.model_json_schema()
+_BATCH_ITEM_SCHEMA["properties"]["id"] = {"type": "integer"}
+_BATCH_ITEM_SCHEMA["required"] = ["id"] + _BATCH_ITEM_SCHEMA["required"]
+
+BATCH_CLEANING_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"schema": {
+        "type": "object",
+        "properties": {"results": {"type": "array", "items": _BATCH_ITEM_SCHEMA}},
+        "required": ["results"],
+    }},
+}
+
 # --------------------------------------------------
-# SIMPLE IN-MEMORY CACHE
+# PERSISTENT DISK CACHE (SURVIVES RESTARTS, SHARED ACROSS WORKERS)
 # --------------------------------------------------
-CACHE = {}
-ENRICHMENT_CACHE = {}
+CACHE_DIR = os.getenv("PROVIDER_CACHE_DIR", ".cache")
+CACHE_SIZE_LIMIT = int(10e9)
+CACHE_TTL = 24 * 3600            # cleaned records: 1 day
+ENRICHMENT_TTL = 7 * 24 * 3600   # search results: 1 week
+FALLBACK_TTL = 5 * 60            # rule-based fallbacks: usually an API outage, retry soon
+
+CACHE = diskcache.Cache(os.path.join(CACHE_DIR, "clean"), size_limit=CACHE_SIZE_LIMIT)
+ENRICHMENT_CACHE = diskcache.Cache(os.path.join(CACHE_DIR, "enrichment"), size_limit=CACHE_SIZE_LIMIT)
+
+def get_cached_result(key: str) -> Optional[ProviderResponse]:
+    raw = CACHE.get(key)
+    return ProviderResponse.model_validate_json(raw) if raw is not None else None
+
+def set_cached_result(key: str, result: ProviderResponse, expire: int = CACHE_TTL):
+    CACHE.set(key, result.model_dump_json(), expire=expire)
+
+# Max concurrent search requests across all threads (API rate limit)
+SEARCH_CONCURRENCY = 3
+SEARCH_SLOTS = threading.BoundedSemaphore(SEARCH_CONCURRENCY)
+
+# --------------------------------------------------
+# SEMANTIC CACHE (NEAR-DUPLICATE PROVIDERS)
+# --------------------------------------------------
+class SemanticCache:
+    """
+    Embedding-based cache so the same doctor with slightly different
+    formatting can fill its gaps from an earlier result instead of a
+    new LLM call.
+    The index is cleared once it holds max_entries or is older than ttl,
+    so it stays bounded and never serves results older than CACHE_TTL.
+    """
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2", threshold: float = 0.95,
+                 max_entries: int = 10_000, ttl: int = CACHE_TTL):
+        self.model_name = model_name
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = faiss is not None and SentenceTransformer is not None
+        self._model = None
+        self._index = None
+        self._results: List[ProviderResponse] = []
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _expire(self):
+        """
+        Drop every entry once the index is full or too old (lock held)
+        """
+        if (len(self._results) >= self.max_entries
+                or time.monotonic() - self._started > self.ttl):
+            self._index.reset()
+            self._results = []
+            self._started = time.monotonic()
+
+    @staticmethod
+    def normalize(provider: Dict) -> str:
+        """
+        Canonical text for a provider: lowercase name + specialty + city
+        """
+        parts = (str(provider.get(field) or "").strip().lower()
+                 for field in ("name", "specialty", "city"))
+        return " ".join(p for p in parts if p)
+
+    def embed(self, provider: Dict):
+        """
+        Return a normalized embedding, or None if the cache can't be used
+        """
+        if not self.enabled or not str(provider.get("name") or "").strip():
+            return None
+        with self._lock:
+            if self._model is None:
+                self._model = SentenceTransformer(self.model_name)
+                self._index = faiss.IndexFlatIP(self._model.get_sentence_embedding_dimension())
+        text = self.normalize(provider)
+        return self._model.encode([text], normalize_embeddings=True).astype("float32")
+
+    def search(self, vector) -> Optional[ProviderResponse]:
+        if vector is None:
+            return None
+        with self._lock:
+            self._expire()
+            if self._index.ntotal == 0:
+                return None
+            scores, ids = self._index.search(vector, 1)
+            if scores[0][0] >= self.threshold:
+                return self._results[ids[0][0]]
+        return None
+
+    def add(self, vector, result: ProviderResponse):
+        if vector is None:
+            return
+        with self._lock:
+            self._expire()
+            self._index.add(vector)
+            self._results.append(result)
+
+    def __len__(self):
+        return len(self._results)
+
+
+SEMANTIC_CACHE = SemanticCache()
 
 # --------------------------------------------------
 # SAFE JSON EXTRACTION
 # --------------------------------------------------
+_JSON_DECODER = json.JSONDecoder()
+
 def extract_json_safely(text: str) -> dict:
     """
-    Extract first valid JSON object from model output
+    Extract the JSON object that starts at the first '{' of model output
     """
-    match = re.search(r"\{[\s\S]*\}", text)
-    if not match:
+    # Structured output is plain JSON; only scan when that fails
+    try:
+        obj = json.loads(text)
+        if isinstance(obj, dict):
+            return obj
+    except json.JSONDecodeError:
+        pass
+    # Only the object at the first top-level brace counts; retrying from
+    # later braces would return a nested dict from a truncated response
+    start = text.find("{")
+    if start == -1:
         raise ValueError("No JSON object found")
-    return json.loads(match.group())
+    obj, _ = _JSON_DECODER.raw_decode(text, start)
+    return obj
+
+def read_json_stream(stream) -> str:
+    """
+    Collect a streamed completion, stopping as soon as the top-level
+    JSON object is complete instead of waiting for trailing tokens
+    """
+    parts = []
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        parts.append(delta)
+        if "}" in delta:
+            text = "".join(parts)
+            start = text.find("{")
+            if start == -1:
+                continue
+            try:
+                _JSON_DECODER.raw_decode(text, start)
+            except json.JSONDecodeError:
+                continue
+            stream.close()
+            return text
+    return "".join(parts)
+
+# --------------------------------------------------
+# STATIC SYSTEM PROMPTS (SHARED PREFIX, CACHEABLE)
+# --------------------------------------------------
+DEFAULT_SYSTEM_PROMPT = "You are a helpful and accurate assistant."
+
+SEARCH_SYSTEM_PROMPT = """The user message is a search query. Find current contact details for the Indian healthcare provider it names using live web search.
+Prefer clinic/hospital sites, Practo, Lybrate, Justdial, government hospital databases, verified profiles.
+Reply with JSON: {"found_info": {"phone", "email", "address", "website", "verified_source"}, "confidence": "high|medium|low", "search_summary": "..."}.
+Use empty strings for anything not found. Never invent information."""
+
+CLEANING_RULES = """Clean, standardize, score:
+- phone: Indian format (+91 XXXXX XXXXX or 0XXXXXXXXXX); email: valid name@domain; address: add city, state, PIN if possible
+- specialty: standard name ('heart doctor'->Cardiology, 'bone doctor'->Orthopedics, 'skin doctor'->Dermatology, etc.)
+- issues: missing required fields, inconsistencies, suspicious/invalid data, note if online data was used
+- accuracy_score (0-100): base 50; +10 complete name, +15 valid phone, +15 valid email, +20 complete address; -20 unverified online data; -30 major inconsistencies
+"""
+
+CLEANED_RECORD_SHAPE = '{"cleaned_data": {"name", "phone", "email", "address", "specialty", "license", "source"}, "issues": [...], "accuracy_score": int}'
+
+CLEANING_SYSTEM_PROMPT = (
+    "You clean healthcare provider records. Input JSON: record, enriched_fields (filled from online search), "
+    "needs (fields originally missing/incomplete).\n"
+    + CLEANING_RULES
+    + f"Reply with JSON: {CLEANED_RECORD_SHAPE}."
+)
+
+BATCH_CLEANING_SYSTEM_PROMPT = (
+    "You clean healthcare provider records in batches. Input JSON: {\"records\": [...]}, each item has "
+    "id, record, enriched_fields (filled from online search), needs (fields originally missing/incomplete).\n"
+    + CLEANING_RULES
+    + f"Reply with JSON: {{\"results\": [...]}} holding one {CLEANED_RECORD_SHAPE} per input record, "
+    "each with the input record's \"id\" copied unchanged."
+)
 
 # --------------------------------------------------
 # PERPLEXITY CALL WITH RETRY + BACKOFF
 # --------------------------------------------------
-def call_perplexity_with_retry(prompt: str, model: str = "sonar-pro", retries: int = 3, wait: int = 5):
+RETRYABLE_ERRORS = (RateLimitError, APIStatusError, APIConnectionError, HTTPError)
+MAX_BACKOFF = 60
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Rate limits, 5xx and connection problems are worth retrying;
+    other 4xx responses will fail the same way again
+    """
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return True
+
+def retry_delay(error: Exception, attempt: int, wait: int) -> float:
+    """
+    Honour Retry-After if the API sent one, else jittered exponential backoff
+    """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(MAX_BACKOFF, float(retry_after))
+    except (TypeError, ValueError):
+        return min(MAX_BACKOFF, wait * 2 ** attempt) + random.uniform(0, 1)
+
+def call_perplexity_with_retry(prompt: str, model: str = "sonar-pro", retries: int = 6, wait: int = 5,
+                               response_format: Optional[dict] = None,
+                               system_prompt: str = DEFAULT_SYSTEM_PROMPT, max_tokens: int = 800):
     last_error = None
+    extra = {"response_format": response_format} if response_format else {}
     for attempt in range(retries):
         try:
-            resp = client.chat.completions.create(
+            stream = client.chat.completions.create(
                 model=model,
                 messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful and accurate assistant."
-                    },
+                    # Invariant system prompt first so the server can reuse its prefix
+                    {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt},
                 ],
                 temperature=0.1,  # Lower temperature for more consistent results
-                max_tokens=800,
+                max_tokens=max_tokens,
+                stream=True,
+                **extra,
             )
-            return resp
-        except HTTPError as e:
+            return read_json_stream(stream)
+        except RETRYABLE_ERRORS as e:
             last_error = e
-            if attempt == retries - 1:
+            if attempt == retries - 1 or not is_retryable(e):
                 raise
-            print(f"⚠️ Request failed. Retrying in {wait} seconds...")
-            time.sleep(wait)
+            delay = retry_delay(e, attempt, wait)
+            print(f"⚠️ Request failed ({type(e).__name__}). Retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
     raise last_error
 
 # --------------------------------------------------
@@ -84,53 +337,23 @@ def search_with_perplexity(query: str) -> Dict:
     """
     Use Perplexity's online capabilities to search for information
     """
-    cache_key = f"search_{hash(query)}"
-    if cache_key in ENRICHMENT_CACHE:
-        return ENRICHMENT_CACHE[cache_key]
+    # Stable across restarts and workers, unlike hash() (PYTHONHASHSEED)
+    cache_key = "search_" + hashlib.blake2b(query.encode(), digest_size=16).hexdigest()
+    cached_data = ENRICHMENT_CACHE.get(cache_key)
+    if cached_data is not None:
+        return cached_data
     
     print(f"🔍 Searching for: {query[:50]}...")
     
-    search_prompt = f"""
-    Search for accurate and current information about: "{query}"
-    
-    IMPORTANT: You MUST use your internet search capabilities to find REAL, CURRENT information.
-    
-    Focus on finding:
-    1. Contact phone numbers (Indian format: +91 XXXX XXX XXX)
-    2. Email addresses
-    3. Complete physical addresses
-    4. Official website or clinic information
-    
-    For healthcare providers in India, look for:
-    - Clinic/hospital websites
-    - Medical directories like Practo, Lybrate, or Justdial
-    - Government hospital databases
-    - Verified doctor profiles
-    
-    Return ONLY a JSON object with this structure:
-    {{
-        "found_info": {{
-            "phone": "phone number if found, else empty string",
-            "email": "email if found, else empty string", 
-            "address": "complete address if found, else empty string",
-            "website": "website URL if found, else empty string",
-            "verified_source": "name of source where info was found"
-        }},
-        "confidence": "high/medium/low based on source reliability",
-        "search_summary": "brief summary of what was found"
-    }}
-    
-    If you cannot find any information, return empty strings but still provide the JSON structure.
-    DO NOT make up information. If not found, leave empty.
-    """
-    
     try:
-        response = call_perplexity_with_retry(search_prompt, model="sonar-pro-online", retries=2)
-        text = response.choices[0].message.content
+        with SEARCH_SLOTS:
+            text = call_perplexity_with_retry(query, model="sonar-pro-online", retries=2,
+                                              response_format=SEARCH_RESPONSE_FORMAT,
+                                              system_prompt=SEARCH_SYSTEM_PROMPT)
         
         # Extract JSON from response
         data = extract_json_safely(text)
-        ENRICHMENT_CACHE[cache_key] = data
+        ENRICHMENT_CACHE.set(cache_key, data, expire=ENRICHMENT_TTL)
         return data
         
     except Exception as e:
@@ -174,12 +397,14 @@ def enrich_provider_with_perplexity(provider: Dict) -> Dict:
     
     all_found_info = {}
     
-    for query in search_queries[:3]:  # Try first 3 queries
-        if all(key in all_found_info and all_found_info[key] 
-               for key in ['phone', 'email', 'address']):
-            break  # Stop if we found all info
-            
-        result = search_with_perplexity(query)
+    # Run the first 3 queries concurrently; SEARCH_SLOTS keeps us
+    # within the API rate limit
+    queries = search_queries[:3]
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        results = list(pool.map(search_with_perplexity, queries))
+    
+    # Merge in query priority order
+    for result in results:
         found_info = result.get('found_info', {})
         
         # Merge results, prioritizing non-empty values
@@ -190,9 +415,6 @@ def enrich_provider_with_perplexity(provider: Dict) -> Dict:
         # Also capture the source
         if found_info.get('verified_source'):
             all_found_info['verified_source'] = found_info['verified_source']
-        
-        # Small delay between searches
-        time.sleep(1)
     
     # Clean and validate the found data
     cleaned_info = {}
@@ -201,7 +423,7 @@ def enrich_provider_with_perplexity(provider: Dict) -> Dict:
     if 'phone' in all_found_info:
         phone = all_found_info['phone']
         # Extract digits
-        digits = re.sub(r'\D', '', phone)
+        digits = DIGITS_RE.sub('', phone)
         if len(digits) == 10:
             cleaned_info['phone'] = f"+91 {digits[:5]} {digits[5:]}"
         elif len(digits) > 10:
@@ -210,7 +432,7 @@ def enrich_provider_with_perplexity(provider: Dict) -> Dict:
     # Validate email
     if 'email' in all_found_info:
         email = all_found_info['email'].strip()
-        if re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', email):
+        if EMAIL_RE.match(email):
             cleaned_info['email'] = email
     
     # Clean address
@@ -231,23 +453,52 @@ def enrich_provider_with_perplexity(provider: Dict) -> Dict:
     return cleaned_info
 
 # --------------------------------------------------
-# ENHANCED CORE CLEANING AGENT
+# CLEANING PHASES (SHARED BY SINGLE AND BATCH PATHS)
 # --------------------------------------------------
-def clean_provider_enhanced(provider: dict) -> ProviderResponse:
+def lookup_cached(provider: dict):
     """
-    Enhanced version that:
-    1. Checks cache
-    2. Searches for missing information using Perplexity
-    3. Cleans and validates all data
+    Check the exact cache.
+    Returns (cache_key, cached result or None)
     """
-    # ---------- CACHE CHECK ----------
     cache_key = json.dumps(provider, sort_keys=True)
-    if cache_key in CACHE:
-        cached_result = CACHE[cache_key]
+    cached_result = get_cached_result(cache_key)
+    if cached_result is not None:
         print(f"Using cached result for {provider.get('name', 'Unknown')}")
-        return cached_result
-    
-    # ---------- ENRICHMENT PHASE ----------
+    return cache_key, cached_result
+
+def lookup_similar(provider: dict):
+    """
+    Check the semantic cache for records that need cleaning. A hit only
+    fills fields that are empty or invalid here; fields the record
+    already has are kept. Returns (vector, result or None), with a
+    result only when the merged record passes every local validator
+    """
+    vector = SEMANTIC_CACHE.embed(provider)
+    similar_result = SEMANTIC_CACHE.search(vector)
+    if similar_result is None:
+        return vector, None
+    
+    invalid = invalid_fields(provider)
+    merged = provider.copy()
+    filled = []
+    for field, value in similar_result.cleaned_data.items():
+        current = str(provider.get(field) or '').strip()
+        if (not current or field in invalid) and str(value or '').strip():
+            merged[field] = value
+            filled.append(field)
+    if not filled or invalid_fields(merged):
+        return vector, None
+    
+    print(f"Filled {', '.join(filled)} from similar cached result for {provider.get('name', 'Unknown')}")
+    result = local_response(merged)
+    result.issues.append(f"Filled from similar cached record: {', '.join(filled)}")
+    return vector, result
+
+def prepare_provider(provider: dict, enrich: bool = True) -> Dict:
+    """
+    Enrichment phase: search for missing contact details and merge them
+    into a copy of the record (skipped when enrich is False)
+    """
     enriched_data = {}
     enriched_fields = []
     
@@ -261,7 +512,7 @@ def clean_provider_enhanced(provider: dict) -> ProviderResponse:
     needs_address = not original_address or len(str(original_address).strip()) < 15
     
     # Only search if we need something
-    if needs_phone or needs_email or needs_address:
+    if enrich and (needs_phone or needs_email or needs_address):
         print(f"🔧 Enriching data for: {provider.get('name', 'Unknown')}")
         enriched_data = enrich_provider_with_perplexity(provider)
         
@@ -280,125 +531,303 @@ def clean_provider_enhanced(provider: dict) -> ProviderResponse:
             if not current_value or (field == 'phone' and len(str(current_value)) < 10):
                 provider_to_clean[field] = value
     
+    return {
+        "provider_to_clean": provider_to_clean,
+        "enriched_data": enriched_data,
+        "enriched_fields": enriched_fields,
+        "needs": [f for f, needed in (("phone", needs_phone), ("email", needs_email),
+                                      ("address", needs_address)) if needed],
+    }
+
+def cleaning_payload(prepared: Dict) -> Dict:
+    return {
+        "record": prepared["provider_to_clean"],
+        "enriched_fields": prepared["enriched_fields"],
+        "needs": prepared["needs"],
+    }
+
+def build_response(data: dict, prepared: Dict) -> ProviderResponse:
+    """
+    Turn the model's JSON for one record into a ProviderResponse
+    """
+    enriched_data = prepared["enriched_data"]
+    enriched_fields = prepared["enriched_fields"]
+    
+    # Extract the cleaned data
+    cleaned_data = data.get("cleaned_data", prepared["provider_to_clean"])
+    issues = data.get("issues", [])
+    accuracy = int(data.get("accuracy_score", 50))
+    
+    # Add enrichment notes to issues
+    if enriched_fields:
+        issues.append(f"Enhanced with online search: {', '.join(enriched_fields)}")
+        if 'source' in enriched_data:
+            issues.append(f"Source: {enriched_data.get('source', 'Online directory')}")
+    
+    return ProviderResponse(
+        cleaned_data=cleaned_data,
+        issues=issues,
+        accuracy_score=accuracy,
+        enriched_fields=enriched_fields
+    )
+
+def fallback_response(prepared: Dict, error: Exception) -> ProviderResponse:
+    """
+    Rule-based cleaning used when the model call or its output fails
+    """
+    enriched_fields = prepared["enriched_fields"]
+    
+    # Simple fallback cleaning
+    cleaned_data = prepared["provider_to_clean"].copy()
+    
+    # Basic phone formatting
+    if 'phone' in cleaned_data:
+        cleaned_data['phone'] = format_indian_phone(cleaned_data['phone'])
+    
+    # Basic specialty standardization
+    if 'specialty' in cleaned_data:
+        cleaned_data['specialty'] = standardize_specialty(cleaned_data['specialty'])
+    
+    return ProviderResponse(
+        cleaned_data=cleaned_data,
+        issues=[f"AI fallback used: {str(error)}"] + 
+               (["Used online data"] if enriched_fields else []),
+        accuracy_score=40 if enriched_fields else 30,
+        enriched_fields=enriched_fields
+    )
+
+# --------------------------------------------------
+# DIFFICULTY ROUTING
+# --------------------------------------------------
+# Cleaning model per tier; "skip" rows never reach the LLM
+TIER_MODELS = {"cheap": "sonar", "full": "sonar-pro"}
+
+# Contact fields that online enrichment can fill when they are empty
+CONTACT_FIELDS = ("phone", "email", "address")
+
+def classify_difficulty(provider: dict) -> str:
+    """
+    skip:  every required field is present and valid
+    cheap: one field needs a format-only fix, cleaned by the cheaper
+           model without search
+    full:  a contact field is empty or several fields are off; enriched
+           online and cleaned by sonar-pro
+    """
+    invalid = invalid_fields(provider)
+    if not invalid:
+        return "skip"
+    missing_contact = [field for field in invalid
+                       if field in CONTACT_FIELDS and not str(provider.get(field) or '').strip()]
+    if len(invalid) == 1 and not missing_contact:
+        return "cheap"
+    return "full"
+
+def local_response(provider: dict) -> ProviderResponse:
+    """
+    Rule-based result for records that need no LLM call
+    """
+    cleaned_data = provider.copy()
+    if 'phone' in cleaned_data:
+        cleaned_data['phone'] = format_indian_phone(cleaned_data['phone'])
+    if 'specialty' in cleaned_data:
+        cleaned_data['specialty'] = standardize_specialty(cleaned_data['specialty'])
+    return ProviderResponse(
+        cleaned_data=cleaned_data,
+        issues=[],
+        accuracy_score=score_record(cleaned_data)
+    )
+
+def resolve_locally(prepared: Dict) -> Optional[ProviderResponse]:
+    """
+    If the enriched record passes every local validator, build the result
+    with the rubric instead of a second LLM call. Returns None otherwise
+    """
+    if invalid_fields(prepared["provider_to_clean"]):
+        return None
+    
+    result = local_response(prepared["provider_to_clean"])
+    enriched_data = prepared["enriched_data"]
+    enriched_fields = prepared["enriched_fields"]
+    if enriched_fields:
+        result.enriched_fields = enriched_fields
+        result.issues.append(f"Enhanced with online search: {', '.join(enriched_fields)}")
+        if 'source' in enriched_data:
+            result.issues.append(f"Source: {enriched_data['source']}")
+        else:
+            # Rubric: -20 for unverified online data
+            result.accuracy_score = max(0, result.accuracy_score - 20)
+    return result
+
+# --------------------------------------------------
+# ENHANCED CORE CLEANING AGENT
+# --------------------------------------------------
+def clean_provider_enhanced(provider: dict) -> ProviderResponse:
+    """
+    Enhanced version that:
+    1. Checks the exact cache
+    2. Routes by difficulty (skip / cheap / full)
+    3. Fills gaps from a semantically similar cached record
+    4. Searches for missing information using Perplexity
+    5. Cleans and validates all data
+    """
+    # ---------- CACHE CHECK ----------
+    cache_key, cached_result = lookup_cached(provider)
+    if cached_result is not None:
+        return cached_result
+    
+    # ---------- ROUTING ----------
+    tier = classify_difficulty(provider)
+    if tier == "skip":
+        return local_response(provider)
+    
+    # ---------- SEMANTIC CACHE ----------
+    vector, similar_result = lookup_similar(provider)
+    if similar_result is not None:
+        set_cached_result(cache_key, similar_result)
+        return similar_result
+    
+    # ---------- ENRICHMENT PHASE ----------
+    prepared = prepare_provider(provider, enrich=(tier == "full"))
+    
+    # Enrichment may already have produced a valid record
+    local_result = resolve_locally(prepared)
+    if local_result is not None:
+        set_cached_result(cache_key, local_result)
+        SEMANTIC_CACHE.add(vector, local_result)
+        return local_result
+    
     # ---------- CLEANING PHASE ----------
-    prompt = f"""
-Input provider record:
-{json.dumps(provider_to_clean, indent=2)}
-
-ENRICHMENT CONTEXT:
-- Some fields may have been enhanced with online search: {enriched_fields if enriched_fields else 'None enhanced'}
-- Original data had issues: Phone: {'Incomplete' if needs_phone else 'OK'}, Email: {'Missing' if needs_email else 'OK'}, Address: {'Incomplete' if needs_address else 'OK'}
-
-TASKS:
-1. VALIDATE & FIX all contact information
-   - Phone: Convert to Indian format (+91 XXXXX XXXXX or 0XXXXXXXXXX)
-   - Email: Ensure valid format (name@domain.com)
-   - Address: Complete with city, state, PIN if possible
-
-2. STANDARDIZE medical specialty
-   - 'heart doctor' → 'Cardiology'
-   - 'bone doctor' → 'Orthopedics' 
-   - 'skin doctor' → 'Dermatology'
-   - etc.
-
-3. IDENTIFY issues:
-   - Missing required fields
-   - Inconsistent information
-   - Suspicious or invalid data
-   - Note if online data was used
-
-4. SCORE accuracy (0-100):
-   - Base score: 50
-   - +10 for complete name
-   - +15 for valid phone
-   - +15 for valid email  
-   - +20 for complete address
-   - -20 if using unverified online data
-   - -30 for major inconsistencies
-
-Return ONLY this JSON (no other text):
-{{
-  "cleaned_data": {{
-    "name": "full name",
-    "phone": "formatted phone",
-    "email": "valid email",
-    "address": "complete address",
-    "specialty": "standardized specialty",
-    "license": "license if available",
-    "source": "note if online data used"
-  }},
-  "issues": ["list", "of", "issues"],
-  "accuracy_score": 75
-}}
-"""
+    prompt = json.dumps(cleaning_payload(prepared), separators=(",", ":"), default=str)
     
     try:
-        response = call_perplexity_with_retry(prompt)
-        text = response.choices[0].message.content
+        text = call_perplexity_with_retry(prompt, model=TIER_MODELS[tier],
+                                          response_format=CLEANING_RESPONSE_FORMAT,
+                                          system_prompt=CLEANING_SYSTEM_PROMPT)
         data = extract_json_safely(text)
+        result = build_response(data, prepared)
         
-        # Extract the cleaned data
-        cleaned_data = data.get("cleaned_data", provider_to_clean)
-        issues = data.get("issues", [])
-        accuracy = int(data.get("accuracy_score", 50))
-        
-        # Add enrichment notes to issues
-        if enriched_fields:
-            issues.append(f"Enhanced with online search: {', '.join(enriched_fields)}")
-            if 'source' in enriched_data:
-                issues.append(f"Source: {enriched_data.get('source', 'Online directory')}")
-        
-        # Create result
-        result = ProviderResponse(
-            cleaned_data=cleaned_data,
-            issues=issues,
-            accuracy_score=accuracy,
-            enriched_fields=enriched_fields
-        )
-        
-        CACHE[cache_key] = result
+        set_cached_result(cache_key, result)
+        SEMANTIC_CACHE.add(vector, result)
         return result
         
     # ---------- FALLBACK ----------
-    except (HTTPError, json.JSONDecodeError, ValidationError, ValueError) as e:
+    except (APIError, HTTPError, json.JSONDecodeError, ValidationError, ValueError) as e:
         print(f"Error in cleaning: {e}")
-        
-        # Simple fallback cleaning
-        cleaned_data = provider_to_clean.copy()
-        
-        # Basic phone formatting
-        if 'phone' in cleaned_data:
-            digits = re.sub(r'\D', '', str(cleaned_data['phone']))
-            if len(digits) == 10:
-                cleaned_data['phone'] = f"+91 {digits[:5]} {digits[5:]}"
-        
-        # Basic specialty standardization
-        specialty_map = {
-            'heart': 'Cardiology',
-            'bone': 'Orthopedics',
-            'skin': 'Dermatology',
-            'eye': 'Ophthalmology',
-            'child': 'Pediatrics',
-            'brain': 'Neurology'
-        }
-        
-        current_specialty = cleaned_data.get('specialty', '').lower()
-        for key, value in specialty_map.items():
-            if key in current_specialty:
-                cleaned_data['specialty'] = value
-                break
-        
-        fallback = ProviderResponse(
-            cleaned_data=cleaned_data,
-            issues=[f"AI fallback used: {str(e)}"] + 
-                   (["Used online data"] if enriched_fields else []),
-            accuracy_score=40 if enriched_fields else 30,
-            enriched_fields=enriched_fields
-        )
-        
-        CACHE[cache_key] = fallback
+        fallback = fallback_response(prepared, e)
+        set_cached_result(cache_key, fallback, expire=FALLBACK_TTL)
         return fallback
 
+# --------------------------------------------------
+# BATCH CLEANING (K RECORDS PER LLM CALL)
+# --------------------------------------------------
+BATCH_SIZE = 10
+BATCH_CONCURRENCY = 5  # batches in flight at once
+
+def _clean_chunk(tier: str, chunk: List[tuple]) -> List[tuple]:
+    """
+    Fill each record from the semantic cache or enrich it, then clean
+    the ones that are still invalid in one call with the tier's model.
+    Returns (index, ProviderResponse) pairs
+    """
+    results = []
+    remaining = []
+    for index, provider, cache_key in chunk:
+        vector, similar_result = lookup_similar(provider)
+        if similar_result is not None:
+            set_cached_result(cache_key, similar_result)
+            results.append((index, similar_result))
+            continue
+        entry = (index, cache_key, vector)
+        prepared = prepare_provider(provider, enrich=(tier == "full"))
+        local_result = resolve_locally(prepared)
+        if local_result is None:
+            remaining.append((entry, prepared))
+            continue
+        set_cached_result(cache_key, local_result)
+        SEMANTIC_CACHE.add(vector, local_result)
+        results.append((index, local_result))
+    
+    if not remaining:
+        return results
+    
+    prompt = json.dumps({"records": [{"id": entry[0], **cleaning_payload(p)} for entry, p in remaining]},
+                        separators=(",", ":"), default=str)
+    
+    try:
+        text = call_perplexity_with_retry(prompt, model=TIER_MODELS[tier],
+                                          response_format=BATCH_CLEANING_RESPONSE_FORMAT,
+                                          system_prompt=BATCH_CLEANING_SYSTEM_PROMPT,
+                                          max_tokens=800 * len(remaining))
+        items = extract_json_safely(text).get("results", [])
+        batch_error = ValueError("Missing or duplicate id in batch response")
+    except (APIError, HTTPError, json.JSONDecodeError, ValidationError, ValueError) as e:
+        print(f"Error in batch cleaning: {e}")
+        items, batch_error = [], e
+    
+    # Match results to records by id, never by position
+    by_id = {}
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and isinstance(item.get("id"), int):
+            by_id.setdefault(item["id"], []).append(item)
+    
+    for (index, cache_key, vector), prepared in remaining:
+        try:
+            matches = by_id.get(index, [])
+            if len(matches) != 1:
+                raise batch_error
+            result = build_response(matches[0], prepared)
+            SEMANTIC_CACHE.add(vector, result)
+            set_cached_result(cache_key, result)
+        except (APIError, HTTPError, ValidationError, ValueError, TypeError) as e:
+            result = fallback_response(prepared, e)
+            set_cached_result(cache_key, result, expire=FALLBACK_TTL)
+        results.append((index, result))
+    return results
+
+def clean_providers_batch(providers: List[dict], k: int = BATCH_SIZE) -> List[ProviderResponse]:
+    """
+    Clean many providers with one LLM call per k uncached records.
+    Exact duplicates are cleaned once. Results are returned in input order
+    """
+    results: List[Optional[ProviderResponse]] = [None] * len(providers)
+    pending = {tier: [] for tier in TIER_MODELS}
+    first_seen = {}
+    duplicates = []  # (index, index of first occurrence)
+    
+    for index, provider in enumerate(providers):
+        row_key = json.dumps(provider, sort_keys=True)
+        if row_key in first_seen:
+            duplicates.append((index, first_seen[row_key]))
+            continue
+        first_seen[row_key] = index
+        
+        cache_key, cached_result = lookup_cached(provider)
+        if cached_result is not None:
+            results[index] = cached_result
+            continue
+        tier = classify_difficulty(provider)
+        if tier == "skip":
+            results[index] = local_response(provider)
+        else:
+            pending[tier].append((index, provider, cache_key))
+    
+    # Each chunk holds records of a single tier so it can use one model
+    tiers, chunks = [], []
+    for tier, rows in pending.items():
+        for i in range(0, len(rows), k):
+            tiers.append(tier)
+            chunks.append(rows[i:i + k])
+    if chunks:
+        with ThreadPoolExecutor(max_workers=min(BATCH_CONCURRENCY, len(chunks))) as pool:
+            for chunk_results in pool.map(_clean_chunk, tiers, chunks):
+                for index, result in chunk_results:
+                    results[index] = result
+    
+    for index, original in duplicates:
+        results[index] = results[original]
+    
+    return results
+
 # --------------------------------------------------
 # LOCAL TEST
 # --------------------------------------------------
@@ -460,4 +889,5 @@ if __name__ == "__main__":
     print(f"\n{'='*60}")
     print("✨ All tests completed!")
     print(f"Total cache entries: {len(CACHE)}")
-    print(f"Enrichment cache entries: {len(ENRICHMENT_CACHE)}")
\ No newline at end of file
+    print(f"Enrichment cache entries: {len(ENRICHMENT_CACHE)}")
+    print(f"Semantic cache entries: {len(SEMANTIC_CACHE)}")
\ No newline at end of file
@@ -0,0 +1,123 @@
+import re
+import pandas as pd
+
+# --------------------------------------------------
+# SHARED PATTERNS
+# --------------------------------------------------
+DIGITS_RE = re.compile(r"\D")
+EMAIL_RE = re.compile(r"^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$")
+
+# Keyword -> standard specialty
+SPECIALTY_MAP = {
+    'heart': 'Cardiology',
+    'bone': 'Orthopedics',
+    'skin': 'Dermatology',
+    'eye': 'Ophthalmology',
+    'child': 'Pediatrics',
+    'brain': 'Neurology'
+}
+
+MIN_ADDRESS_LENGTH = 15
+
+# 91 country code on a 12-digit number
+COUNTRY_CODE = '91'
+
+# Rubric points per valid required field
+FIELD_POINTS = {'name': 10, 'phone': 15, 'email': 15, 'address': 20}
+
+# --------------------------------------------------
+# RECORD-LEVEL CLEANERS
+# --------------------------------------------------
+def format_indian_phone(phone) -> str:
+    """
+    Format a 10-digit number, or a 12-digit one starting with 91, as
+    +91 XXXXX XXXXX, else return it unchanged
+    """
+    digits = DIGITS_RE.sub('', str(phone))
+    if len(digits) == 12 and digits.startswith(COUNTRY_CODE):
+        digits = digits[2:]
+    if len(digits) == 10:
+        return f"+91 {digits[:5]} {digits[5:]}"
+    return phone
+
+def standardize_specialty(specialty) -> str:
+    """
+    First SPECIALTY_MAP keyword (in map order) found in the text wins
+    """
+    current_specialty = str(specialty or '').lower()
+    for key, value in SPECIALTY_MAP.items():
+        if key in current_specialty:
+            return value
+    return specialty
+
+def is_valid_phone(phone) -> bool:
+    """
+    10-digit number, or one already prefixed with the 91 country code
+    """
+    digits = DIGITS_RE.sub('', str(phone or ''))
+    return len(digits) == 10 or (len(digits) == 12 and digits.startswith(COUNTRY_CODE))
+
+def invalid_fields(record: dict) -> list:
+    """
+    Required fields that are missing or fail validation
+    """
+    invalid = []
+    if not str(record.get('name') or '').strip():
+        invalid.append('name')
+    if not is_valid_phone(record.get('phone')):
+        invalid.append('phone')
+    if not EMAIL_RE.match(str(record.get('email') or '').strip()):
+        invalid.append('email')
+    if len(str(record.get('address') or '').strip()) < MIN_ADDRESS_LENGTH:
+        invalid.append('address')
+    return invalid
+
+def score_record(record: dict) -> int:
+    """
+    Accuracy rubric: base 50, +10 name, +15 phone, +15 email, +20 address
+    """
+    invalid = invalid_fields(record)
+    score = 50 + sum(points for field, points in FIELD_POINTS.items() if field not in invalid)
+    return min(score, 100)
+
+# --------------------------------------------------
+# VECTORIZED PRE-CLEANING
+# --------------------------------------------------
+def preclean_dataframe(df: pd.DataFrame):
+    """
+    Apply the rule-based cleaners to the whole frame at once.
+    Returns (cleaned df, needs_llm mask); only rows in the mask still
+    have something the LLM has to fix.
+    """
+    df = df.copy()
+    empty = pd.Series("", index=df.index)
+
+    def column(name):
+        return df[name].fillna("").astype(str).str.strip() if name in df else empty
+
+    name = column("name")
+    phone_digits = column("phone").str.replace(DIGITS_RE, "", regex=True)
+    email = column("email")
+    address = column("address")
+
+    with_code = (phone_digits.str.len() == 12) & phone_digits.str.startswith(COUNTRY_CODE)
+    national = phone_digits.where(~with_code, phone_digits.str[2:])
+    valid_phone = national.str.len() == 10
+    if "phone" in df:
+        df.loc[valid_phone, "phone"] = "+91 " + national.str[:5] + " " + national.str[5:]
+
+    if "specialty" in df:
+        # Same precedence as standardize_specialty: map order, not position
+        lower = column("specialty").str.lower()
+        standard = pd.Series(pd.NA, index=df.index, dtype=object)
+        for key, value in SPECIALTY_MAP.items():
+            standard = standard.mask(standard.isna() & lower.str.contains(key, regex=False), value)
+        df["specialty"] = standard.fillna(df["specialty"])
+
+    valid_email = email.str.match(EMAIL_RE)
+    if "email" in df:
+        df.loc[valid_email, "email"] = email
+
+    needs_llm = ~((name != "") & valid_phone & valid_email
+                  & (address.str.len() >= MIN_ADDRESS_LENGTH))
+    return df, needs_llm